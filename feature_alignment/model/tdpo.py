@@ -1,15 +1,64 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 from typing import Dict, List, Union, Tuple
+from omegaconf import DictConfig
 from ..utils.util import detach_float_metrics
 from .dpo import DPOModel
+from .tdpo_fused import fused_tdpo_logps
+from .tdpo_numba import HAS_NUMBA, numba_tdpo_logps
+
+def _tdpo_core_impl(
+    logits: torch.FloatTensor,
+    reference_logits: torch.FloatTensor,
+    labels: torch.LongTensor,
+    loss_mask: torch.BoolTensor,
+):
+    """Per-sequence sums of the logps margin, kl divergence and policy logps, plus the number of unmasked tokens.
+
+    Expects labels that are already shifted, i.e. logits[:, t] predicts labels[:, t], with masked labels replaced by a dummy token.
+    The logits should be contiguous so that they fold into a (batch_size * sequence_length, vocab_size) view without a copy.
+    """
+    B, T, V = logits.shape
+    if reference_logits.dtype == torch.float8_e4m3fn:
+        # softmax kernels don't take fp8 inputs
+        reference_logits = reference_logits.float()
+    logits = logits.reshape(B * T, V)
+    reference_logits = reference_logits.reshape(B * T, V)
+    labels = labels.reshape(-1)
+
+    # labelled policy logps are gathered from the raw logits and normalized with the per-row lse (log p = x - lse)
+    lse = torch.logsumexp(logits.float(), dim=-1, keepdim=True)
+    # upcast inside the softmax kernel so the reference logits themselves can stay in half precision
+    reference_vocab_logps = F.log_softmax(reference_logits, dim=-1, dtype=torch.float32)
+
+    # normalize before taking the difference: sum(p_ref * (log p_ref - x)) + lse is a small kl recovered from two
+    # O(lse) terms and cancels catastrophically. Plain fp32 mul + sum, since einsum would lower to a bf16 bmm under autocast.
+    per_position_kl = (reference_vocab_logps.exp() * (reference_vocab_logps - (logits.float() - lse))).sum(-1).view(B, T)
+    row_idx = torch.arange(B * T, device=labels.device)
+    per_token_logps = (logits[row_idx, labels].float() - lse.squeeze(-1)).view(B, T)
+    per_reference_token_logps = reference_vocab_logps[row_idx, labels].view(B, T)
+    logps_margin = per_token_logps - per_reference_token_logps
+
+    # mask once, in the reductions
+    mask_f = loss_mask.float()
+    return (logps_margin * mask_f).sum(-1), \
+        (per_position_kl * mask_f).sum(-1), \
+        (per_token_logps * mask_f).sum(-1), \
+        mask_f.sum(-1)
+
+# compiled lazily on first call; dynamic shapes since sequence length changes from batch to batch
+_tdpo_core = torch.compile(_tdpo_core_impl, dynamic=True, fullgraph=True)
 
 def tdpo_get_batch_logps(
     logits: torch.FloatTensor, 
     reference_logits: torch.FloatTensor, 
     labels: torch.LongTensor,
     average_log_prob: bool = False,
+    compile: bool = False,
+    fused: bool = False,
+    numba: bool = False,
 ):
     """Compute the kl divergence/log probabilities of the given labels under the given logits.
 
@@ -18,6 +67,9 @@ def tdpo_get_batch_logps(
         reference_logits: Logits of the reference model (unnormalized). Shape: (batch_size, sequence_length, vocab_size)
         labels: Labels for which to compute the log probabilities. Label tokens with a value of -100 are ignored. Shape: (batch_size, sequence_length)
         average_log_prob: If True, return the average log probability per (non-masked) token. Otherwise, return the sum of the log probabilities of the (non-masked) tokens.
+        compile: If True, run the vocab-sized computation through torch.compile so the softmaxes, kl and gathers are fused into a single pass over the logits.
+        fused: If True and the logits are on GPU, use the hand-written Triton kernel in tdpo_fused instead (takes precedence over compile).
+        numba: If True, numba is installed and the logits are on CPU and do not require grad, use the numba kernel in tdpo_numba instead.
 
     Returns:
         Several tensors of shape (batch_size,) containing the average/sum kl divergence/log probabilities of the given labels under the given logits.
@@ -25,38 +77,69 @@ def tdpo_get_batch_logps(
     assert logits.shape[:-1] == labels.shape
     assert reference_logits.shape[:-1] == labels.shape
 
-    labels = labels[:, 1:].clone()
-    logits = logits[:, :-1, :]
-   
-    reference_logits = reference_logits[:, :-1, :]
-
-    loss_mask = (labels != -100)
+    if fused and logits.is_cuda:
+        logps_margin, position_kl, logps, mask_sum = fused_tdpo_logps(logits, reference_logits, labels)
+    elif numba and HAS_NUMBA and logits.device.type == 'cpu' and not logits.requires_grad:
+        logps_margin, position_kl, logps, mask_sum = numba_tdpo_logps(logits, reference_logits, labels)
+    else:
+        # shift the labels rather than slicing the logits, so the logits stay contiguous; the last position predicts nothing
+        labels = F.pad(labels[:, 1:], (0, 1), value=-100)
 
-    # dummy token; we'll ignore the losses on these tokens later
-    labels[labels == -100] = 0
+        loss_mask = (labels != -100)
 
-    vocab_logps = logits.log_softmax(-1)
+        # dummy token; we'll ignore the losses on these tokens later
+        labels = labels.masked_fill(~loss_mask, 0)
 
-    reference_vocab_ps = reference_logits.softmax(-1)
-    reference_vocab_logps = reference_vocab_ps.log()
-
-    per_position_kl = (reference_vocab_ps * (reference_vocab_logps - vocab_logps)).sum(-1)
-    per_token_logps = torch.gather(vocab_logps, dim=2, index=labels.unsqueeze(2)).squeeze(2) * loss_mask
-    per_reference_token_logps = torch.gather(reference_vocab_logps, dim=2, index=labels.unsqueeze(2)).squeeze(2) * loss_mask
-    logps_margin = per_token_logps - per_reference_token_logps
+        core = _tdpo_core if compile else _tdpo_core_impl
+        logps_margin, position_kl, logps, mask_sum = core(logits, reference_logits, labels, loss_mask)
 
     if average_log_prob:
-        return (logps_margin * loss_mask).sum(-1) / loss_mask.sum(-1), \
-               (per_position_kl * loss_mask).sum(-1) / loss_mask.sum(-1), \
-               (per_token_logps * loss_mask).sum(-1) / loss_mask.sum(-1)
+        # fully masked sequences average to 0 rather than nan
+        mask_count = mask_sum.clamp_min(1)
+        return logps_margin / mask_count, position_kl / mask_count, logps / mask_count
     else:
-        return (logps_margin * loss_mask).sum(-1), \
-            (per_position_kl * loss_mask).sum(-1), \
-            (per_token_logps * loss_mask).sum(-1), \
+        return logps_margin, position_kl, logps
+
+def _tdpo_loss_impl(
+    chosen_logps_margin: torch.FloatTensor,
+    rejected_logps_margin: torch.FloatTensor,
+    chosen_position_kl: torch.FloatTensor,
+    rejected_position_kl: torch.FloatTensor,
+    beta: float,
+    alpha: float,
+) -> Tuple[torch.FloatTensor, torch.FloatTensor, torch.FloatTensor]:
+    """Shared TDPO-1/2 loss arithmetic; TDPO-1 is alpha = 1, TDPO-2 passes a detached chosen_position_kl."""
+    chosen_values = chosen_logps_margin + chosen_position_kl
+    rejected_values = rejected_logps_margin + rejected_position_kl
+
+    chosen_rejected_logps_margin = chosen_logps_margin - rejected_logps_margin
+
+    logits = chosen_rejected_logps_margin - alpha * (rejected_position_kl - chosen_position_kl)
+    # equal to -logsigmoid(beta * logits), as a single fused kernel
+    losses = F.binary_cross_entropy_with_logits(beta * logits, torch.ones_like(logits), reduction='none')
+
+    chosen_rewards = beta * chosen_values.detach()
+    rejected_rewards = beta * rejected_values.detach()
+
+    return losses, chosen_rewards, rejected_rewards
+
+# a handful of (batch_size,) elementwise ops, so the cost is kernel launches; compiling fuses them into one and
+# reduce-overhead replays it as a CUDA graph. The batch size does change (train_bs vs eval_bs, a short final batch):
+# the first change triggers a recompile with the dim marked dynamic, and each new size records its own graph.
+# The returned losses/rewards live in the CUDA-graph memory pool and are overwritten by the next replay, so callers
+# must consume (or clone) them within the step and never hold them across steps.
+_tdpo_loss = torch.compile(_tdpo_loss_impl, mode="reduce-overhead", fullgraph=True)
 
 class TDPO1Model(DPOModel):
     """TDPO-1/2 Trainer."""
 
+    def __init__(self, config: DictConfig):
+        super().__init__(config)
+        # reversed arange used to pair chosen/rejected rewards for the unpaired accuracy; rebuilt when the batch size changes
+        self._flip_idx = None
+        # policy + reference forward traced as one graph; built on first use, only with loss.compile_forward
+        self._compiled_policy_reference_forward = None
+
     def loss(
         self, 
         chosen_logps_margin: torch.FloatTensor,
@@ -77,21 +160,18 @@ class TDPO1Model(DPOModel):
             A tuple of two tensors: (losses, rewards).
             The losses tensor contains the TDPO loss for each example in the batch.
             The rewards tensors contain the rewards for response pair.
+            On GPU these are CUDA-graph outputs that the next call overwrites; don't keep them across steps.
         """
 
-        chosen_values = chosen_logps_margin + chosen_position_kl
-        rejected_values = rejected_logps_margin + rejected_position_kl
-
-        chosen_rejected_logps_margin = chosen_logps_margin - rejected_logps_margin
-
-        logits = chosen_rejected_logps_margin - (rejected_position_kl - chosen_position_kl)
-        beta = self.config.loss.beta
-        losses = -F.logsigmoid(beta * logits)
-
-        chosen_rewards = self.config.loss.beta * chosen_values.detach()
-        rejected_rewards = beta * rejected_values.detach()
-
-        return losses, chosen_rewards, rejected_rewards
+        loss_fn = _tdpo_loss if chosen_logps_margin.is_cuda else _tdpo_loss_impl
+        return loss_fn(
+            chosen_logps_margin,
+            rejected_logps_margin,
+            chosen_position_kl,
+            rejected_position_kl,
+            beta=self.config.loss.beta,
+            alpha=1.0,
+        )
        
     def forward(
         self, 
@@ -102,24 +182,11 @@ class TDPO1Model(DPOModel):
         """Run the given model on the given batch of inputs, concatenating the chosen and rejected inputs together.
         """
         concatenated_batch = self.concatenated_inputs(batch)
-        all_logits = model(
-            concatenated_batch['concatenated_combined_input_ids'], 
-            attention_mask=concatenated_batch['concatenated_combined_attention_mask'], 
-            use_cache=(not self.is_mistral)
-        ).logits.to(self.precision)
-        with torch.no_grad():
-            reference_all_logits = self.reference_model(
-                concatenated_batch['concatenated_combined_input_ids'], 
-                attention_mask=concatenated_batch['concatenated_combined_attention_mask'], 
-                use_cache=(not self.is_mistral)
-            ).logits.to(self.precision)
-
-        all_logps_margin, all_position_kl, all_logps = tdpo_get_batch_logps(
-            all_logits, 
-            reference_all_logits, 
-            concatenated_batch['concatenated_labels'], 
-            average_log_prob=False
-        )
+        chunk_size = self.config.loss.get('logits_chunk_size', None)
+        if chunk_size:
+            all_logps_margin, all_position_kl, all_logps = self.chunked_forward(model, concatenated_batch, chunk_size)
+        else:
+            all_logps_margin, all_position_kl, all_logps = self.full_forward(model, concatenated_batch)
 
         chosen_logps_margin = all_logps_margin[:batch['chosen_input_ids'].shape[0]]
         rejected_logps_margin = all_logps_margin[batch['chosen_input_ids'].shape[0]:]
@@ -132,6 +199,139 @@ class TDPO1Model(DPOModel):
         return chosen_logps_margin, rejected_logps_margin, chosen_position_kl, \
             rejected_position_kl, chosen_logps, rejected_logps
 
+    def full_forward(
+        self,
+        model: nn.Module,
+        concatenated_batch: Dict[str, torch.LongTensor],
+    ) -> Tuple[torch.FloatTensor, torch.FloatTensor, torch.FloatTensor]:
+        """Materialize the full (2 * batch_size, sequence_length, vocab_size) logits of the policy and reference model and reduce them."""
+        if self.config.loss.get('compile_forward', False):
+            if self._compiled_policy_reference_forward is None:
+                self._compiled_policy_reference_forward = torch.compile(self.policy_reference_forward)
+            policy_reference_forward = self._compiled_policy_reference_forward
+        else:
+            policy_reference_forward = self.policy_reference_forward
+        all_logits, reference_all_logits = policy_reference_forward(
+            model,
+            self.reference_model,
+            concatenated_batch['concatenated_combined_input_ids'], 
+            concatenated_batch['concatenated_combined_attention_mask'], 
+        )
+
+        all_logps_margin, all_position_kl, all_logps = tdpo_get_batch_logps(
+            all_logits, 
+            reference_all_logits, 
+            concatenated_batch['concatenated_labels'], 
+            average_log_prob=False,
+            compile=torch.cuda.is_available() and not self.is_mistral,
+            fused=self.config.loss.get('fused_kl', False),
+            numba=self.config.loss.get('numba_kl', False),
+        )
+
+        return all_logps_margin, all_position_kl, all_logps
+
+    def policy_reference_forward(
+        self,
+        model: nn.Module,
+        reference_model: nn.Module,
+        input_ids: torch.LongTensor,
+        attention_mask: torch.LongTensor,
+    ) -> Tuple[torch.FloatTensor, torch.FloatTensor]:
+        """Run the policy and the reference model on the same inputs, returning both full logits."""
+        all_logits = model(
+            input_ids, 
+            attention_mask=attention_mask, 
+            use_cache=False
+        ).logits.to(self.precision)
+        # the reference logits are only used under no_grad; with bf16 weights let its matmuls emit bf16 directly, any other
+        # weight dtype keeps its own precision (autocasting would re-cast the weights every step, and needs bf16 support)
+        reference_dtype = next(reference_model.parameters()).dtype
+        with torch.no_grad(), torch.autocast(
+            device_type=self.device.type, dtype=torch.bfloat16, enabled=reference_dtype == torch.bfloat16
+        ):
+            reference_all_logits = reference_model(
+                input_ids, 
+                attention_mask=attention_mask, 
+                use_cache=False
+            ).logits.to(reference_dtype)
+            if self.config.loss.get('reference_logits_fp8', False):
+                # softmax is shift invariant: subtract the row max so every logit is <= 0, and clamp to the e4m3 range
+                # (out-of-range values would become nan); upcast again wherever the logits are read
+                reference_all_logits = (
+                    reference_all_logits - reference_all_logits.max(-1, keepdim=True).values
+                ).clamp_min(-448).to(torch.float8_e4m3fn)
+        return all_logits, reference_all_logits
+
+    def lm_logits(self, model: nn.Module, hidden_states: torch.FloatTensor, dtype: torch.dtype = None) -> torch.FloatTensor:
+        """Apply the LM head (and final logit soft-capping, for Gemma-2) of the given model to its last hidden states."""
+        logits = model.get_output_embeddings()(hidden_states)
+        softcap = getattr(model.config, 'final_logit_softcapping', None)
+        if softcap is not None:
+            logits = torch.tanh(logits / softcap) * softcap
+        return logits.to(dtype or self.precision)
+
+    def chunked_forward(
+        self,
+        model: nn.Module,
+        concatenated_batch: Dict[str, torch.LongTensor],
+        chunk_size: int,
+    ) -> Tuple[torch.FloatTensor, torch.FloatTensor, torch.FloatTensor]:
+        """Same as full_forward, but never holds more than chunk_size positions of logits at once.
+
+        Only the decoders are run on the whole sequence; the LM heads are applied chunk by chunk and each chunk is reduced
+        immediately. The policy chunks are checkpointed, so the backward pass recomputes their logits instead of storing them.
+        """
+        input_ids = concatenated_batch['concatenated_combined_input_ids']
+        attention_mask = concatenated_batch['concatenated_combined_attention_mask']
+        labels = concatenated_batch['concatenated_labels']
+
+        hidden_states = model.base_model(
+            input_ids, 
+            attention_mask=attention_mask, 
+            use_cache=False
+        )[0]
+        # same reference precision as in policy_reference_forward
+        reference_dtype = next(self.reference_model.parameters()).dtype
+        reference_autocast = reference_dtype == torch.bfloat16
+        with torch.no_grad(), torch.autocast(device_type=self.device.type, dtype=torch.bfloat16, enabled=reference_autocast):
+            reference_hidden_states = self.reference_model.base_model(
+                input_ids, 
+                attention_mask=attention_mask, 
+                use_cache=False
+            )[0]
+
+        # position t predicts labels[:, t + 1]; the last position predicts nothing
+        labels = F.pad(labels[:, 1:], (0, 1), value=-100)
+        loss_mask = (labels != -100)
+        # dummy token; we'll ignore the losses on these tokens later
+        labels = labels.masked_fill(~loss_mask, 0)
+
+        core = _tdpo_core if torch.cuda.is_available() and not self.is_mistral else _tdpo_core_impl
+
+        def reduce_chunk(hidden_chunk, reference_hidden_chunk, labels_chunk, mask_chunk):
+            logits = self.lm_logits(model, hidden_chunk)
+            with torch.no_grad(), torch.autocast(device_type=self.device.type, dtype=torch.bfloat16, enabled=reference_autocast):
+                reference_logits = self.lm_logits(self.reference_model, reference_hidden_chunk, dtype=reference_dtype)
+            return core(logits, reference_logits, labels_chunk, mask_chunk)
+
+        all_logps_margin, all_position_kl, all_logps = 0, 0, 0
+        for t0 in range(0, labels.shape[1], chunk_size):
+            chunk = (
+                hidden_states[:, t0:t0 + chunk_size],
+                reference_hidden_states[:, t0:t0 + chunk_size],
+                labels[:, t0:t0 + chunk_size],
+                loss_mask[:, t0:t0 + chunk_size],
+            )
+            if torch.is_grad_enabled():
+                logps_margin, position_kl, logps, _ = checkpoint(reduce_chunk, *chunk, use_reentrant=False)
+            else:
+                logps_margin, position_kl, logps, _ = reduce_chunk(*chunk)
+            all_logps_margin = all_logps_margin + logps_margin
+            all_position_kl = all_position_kl + position_kl
+            all_logps = all_logps + logps
+
+        return all_logps_margin, all_position_kl, all_logps
+
     def get_batch_metrics(self, batch: Dict[str, Union[List, torch.LongTensor]], mode: str=None):
         """Compute the loss and other metrics for the given batch of inputs."""
         metrics = {}
@@ -149,8 +349,10 @@ class TDPO1Model(DPOModel):
         losses = losses.mean()
 
         # accuracy calculated on unpaired examples (for apples-to-apples comparison with UnpairedPreferenceTrainer)
+        if self._flip_idx is None or len(self._flip_idx) != len(rejected_rewards) or self._flip_idx.device != rejected_rewards.device:
+            self._flip_idx = torch.arange(len(rejected_rewards) - 1, -1, -1, device=rejected_rewards.device)
         reward_accuracies = (
-            chosen_rewards > rejected_rewards.flip(dims=[0])
+            chosen_rewards > rejected_rewards.index_select(0, self._flip_idx)
         ).float()
 
         metrics[f'rewards_{mode}/chosen'] = chosen_rewards
@@ -188,19 +390,15 @@ class TDPO2Model(TDPO1Model):
             A tuple of two tensors: (losses, rewards).
             The losses tensor contains the TDPO loss for each example in the batch.
             The rewards tensors contain the rewards for response pair.
+            On GPU these are CUDA-graph outputs that the next call overwrites; don't keep them across steps.
         """
 
-        chosen_values = chosen_logps_margin + chosen_position_kl
-        rejected_values = rejected_logps_margin + rejected_position_kl
-
-        chosen_rejected_logps_margin = chosen_logps_margin - rejected_logps_margin
-
-        alpha = self.config.loss.alpha
-        beta = self.config.loss.beta
-        logits = chosen_rejected_logps_margin - alpha * (rejected_position_kl - chosen_position_kl.detach())
-        losses = -F.logsigmoid(beta * logits)
-
-        chosen_rewards = beta * chosen_values.detach()
-        rejected_rewards = beta * rejected_values.detach()
-
-        return losses, chosen_rewards, rejected_rewards   
\ No newline at end of file
+        loss_fn = _tdpo_loss if chosen_logps_margin.is_cuda else _tdpo_loss_impl
+        return loss_fn(
+            chosen_logps_margin,
+            rejected_logps_margin,
+            chosen_position_kl.detach(),
+            rejected_position_kl,
+            beta=self.config.loss.beta,
+            alpha=self.config.loss.alpha,
+        )   
\ No newline at end of file
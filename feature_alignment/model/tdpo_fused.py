@@ -0,0 +1,260 @@
+import torch
+import torch.nn.functional as F
+from typing import Tuple
+
+try:
+    import triton
+    import triton.language as tl
+    HAS_TRITON = True
+except ImportError:
+    HAS_TRITON = False
+
+
+if HAS_TRITON:
+    @triton.jit
+    def fused_kl_gather_kernel(
+        logits_ptr,
+        ref_ptr,
+        labels_ptr,
+        out_logps_ptr,
+        out_ref_logps_ptr,
+        out_kl_ptr,
+        out_lse_ptr,
+        out_ref_lse_ptr,
+        V,
+        stride_logits,
+        stride_ref,
+        BLOCK_V: tl.constexpr,
+    ):
+        """One program per row: streams the policy and reference logits once, BLOCK_V columns at a time, using the
+        online softmax recurrence for both log-normalizers and for the kl term, then gathers the labelled logits."""
+        row = tl.program_id(0).to(tl.int64)
+        logits_ptr += row * stride_logits
+        ref_ptr += row * stride_ref
+
+        m = float("-inf")
+        d = 0.0
+        ref_m = float("-inf")
+        ref_d = 0.0
+        # sum(exp(r - ref_m) * (r - x)), rescaled together with ref_d so that
+        # kl = ref_a / ref_d - ref_lse + lse
+        ref_a = 0.0
+        for v0 in range(0, V, BLOCK_V):
+            offs = v0 + tl.arange(0, BLOCK_V)
+            valid = offs < V
+            x = tl.load(logits_ptr + offs, mask=valid, other=float("-inf")).to(tl.float32)
+            r = tl.load(ref_ptr + offs, mask=valid, other=float("-inf")).to(tl.float32)
+
+            m_new = tl.maximum(m, tl.max(x, 0))
+            d = d * tl.exp(m - m_new) + tl.sum(tl.exp(x - m_new), 0)
+            m = m_new
+
+            ref_m_new = tl.maximum(ref_m, tl.max(r, 0))
+            scale = tl.exp(ref_m - ref_m_new)
+            e = tl.exp(r - ref_m_new)
+            ref_d = ref_d * scale + tl.sum(e, 0)
+            ref_a = ref_a * scale + tl.sum(tl.where(valid, e * (r - x), 0.0), 0)
+            ref_m = ref_m_new
+
+        lse = m + tl.log(d)
+        ref_lse = ref_m + tl.log(ref_d)
+
+        label = tl.load(labels_ptr + row)
+        x_label = tl.load(logits_ptr + label).to(tl.float32)
+        r_label = tl.load(ref_ptr + label).to(tl.float32)
+
+        tl.store(out_logps_ptr + row, x_label - lse)
+        tl.store(out_ref_logps_ptr + row, r_label - ref_lse)
+        tl.store(out_kl_ptr + row, ref_a / ref_d - ref_lse + lse)
+        tl.store(out_lse_ptr + row, lse)
+        tl.store(out_ref_lse_ptr + row, ref_lse)
+
+    @triton.jit
+    def fused_kl_gather_backward_kernel(
+        logits_ptr,
+        ref_ptr,
+        labels_ptr,
+        lse_ptr,
+        ref_lse_ptr,
+        grad_logps_ptr,
+        grad_kl_ptr,
+        grad_logits_ptr,
+        V,
+        stride_logits,
+        stride_ref,
+        stride_grad,
+        BLOCK_V: tl.constexpr,
+    ):
+        """Gradient w.r.t. the policy logits, one program per row and BLOCK_V columns at a time:
+        grad = grad_logps * (onehot - p) + grad_kl * (p - p_ref), with p and p_ref rebuilt from the saved log-normalizers."""
+        row = tl.program_id(0).to(tl.int64)
+        logits_ptr += row * stride_logits
+        ref_ptr += row * stride_ref
+        grad_logits_ptr += row * stride_grad
+
+        lse = tl.load(lse_ptr + row)
+        ref_lse = tl.load(ref_lse_ptr + row)
+        grad_logps = tl.load(grad_logps_ptr + row)
+        grad_kl = tl.load(grad_kl_ptr + row)
+        label = tl.load(labels_ptr + row)
+
+        for v0 in range(0, V, BLOCK_V):
+            offs = v0 + tl.arange(0, BLOCK_V)
+            valid = offs < V
+            x = tl.load(logits_ptr + offs, mask=valid, other=float("-inf")).to(tl.float32)
+            r = tl.load(ref_ptr + offs, mask=valid, other=float("-inf")).to(tl.float32)
+
+            p = tl.exp(x - lse)
+            ref_p = tl.exp(r - ref_lse)
+            grad = (grad_kl - grad_logps) * p - grad_kl * ref_p
+            grad = tl.where(offs == label, grad + grad_logps, grad)
+            tl.store(grad_logits_ptr + offs, grad.to(grad_logits_ptr.dtype.element_ty), mask=valid)
+
+
+def _launch_config(V: int):
+    # cap the tile at 8192 columns so a row's working set for both models stays cache resident across the loop
+    BLOCK_V = min(triton.next_power_of_2(V), 8192)
+    return BLOCK_V, min(max(BLOCK_V // 256, 4), 32)
+
+
+def _fused_kl_gather_triton(
+    logits: torch.Tensor,
+    reference_logits: torch.Tensor,
+    labels: torch.Tensor,
+) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+    logits = logits.contiguous()
+    reference_logits = reference_logits.contiguous()
+    labels = labels.contiguous()
+    N, V = logits.shape
+
+    BLOCK_V, num_warps = _launch_config(V)
+    outputs = [torch.empty(N, dtype=torch.float32, device=logits.device) for _ in range(5)]
+    fused_kl_gather_kernel[(N,)](
+        logits, reference_logits, labels, *outputs,
+        V, logits.stride(0), reference_logits.stride(0),
+        BLOCK_V=BLOCK_V, num_warps=num_warps,
+    )
+    return tuple(outputs)
+
+
+def _fused_kl_gather_backward_triton(logits, reference_logits, labels, lse, ref_lse, grad_logps, grad_kl):
+    logits = logits.contiguous()
+    reference_logits = reference_logits.contiguous()
+    N, V = logits.shape
+
+    BLOCK_V, num_warps = _launch_config(V)
+    grad_logits = torch.empty_like(logits)
+    fused_kl_gather_backward_kernel[(N,)](
+        logits, reference_logits, labels.contiguous(), lse, ref_lse,
+        grad_logps.float().contiguous(), grad_kl.float().contiguous(), grad_logits,
+        V, logits.stride(0), reference_logits.stride(0), grad_logits.stride(0),
+        BLOCK_V=BLOCK_V, num_warps=num_warps,
+    )
+    return grad_logits
+
+
+def _fused_kl_gather_torch(
+    logits: torch.Tensor,
+    reference_logits: torch.Tensor,
+    labels: torch.Tensor,
+) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+    logits = logits.float()
+    reference_logits = reference_logits.float()
+
+    lse = logits.logsumexp(-1)
+    ref_lse = reference_logits.logsumexp(-1)
+    ref_ps = (reference_logits - ref_lse.unsqueeze(-1)).exp()
+    kl = (ref_ps * (reference_logits - logits)).sum(-1) - ref_lse + lse
+
+    logps = logits.gather(1, labels.unsqueeze(1)).squeeze(1) - lse
+    ref_logps = reference_logits.gather(1, labels.unsqueeze(1)).squeeze(1) - ref_lse
+    return logps, ref_logps, kl, lse, ref_lse
+
+
+@torch.library.custom_op("feature_alignment::fused_kl_gather", mutates_args=())
+def fused_kl_gather(
+    logits: torch.Tensor,
+    reference_logits: torch.Tensor,
+    labels: torch.Tensor,
+) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+    """Row-wise log probabilities of the labels under the policy and the reference, and kl(reference || policy).
+
+    Args:
+        logits: Logits of the model (unnormalized). Shape: (num_rows, vocab_size)
+        reference_logits: Logits of the reference model (unnormalized). Shape: (num_rows, vocab_size)
+        labels: Labels to gather, all within [0, vocab_size). Shape: (num_rows,)
+
+    Returns:
+        (logps, reference_logps, kl, lse, reference_lse), each float32 of shape (num_rows,).
+        Only logps and kl are differentiable, and only w.r.t. the policy logits; the log-normalizers are returned for the backward pass.
+    """
+    if logits.is_cuda and HAS_TRITON:
+        return _fused_kl_gather_triton(logits, reference_logits, labels)
+    return _fused_kl_gather_torch(logits, reference_logits, labels)
+
+
+@fused_kl_gather.register_fake
+def _(logits, reference_logits, labels):
+    return tuple(logits.new_empty(logits.shape[0], dtype=torch.float32) for _ in range(5))
+
+
+def _setup_context(ctx, inputs, output):
+    logits, reference_logits, labels = inputs
+    _, _, _, lse, ref_lse = output
+    ctx.save_for_backward(logits, reference_logits, labels, lse, ref_lse)
+
+
+def _backward(ctx, grad_logps, grad_ref_logps, grad_kl, grad_lse, grad_ref_lse):
+    logits, reference_logits, labels, lse, ref_lse = ctx.saved_tensors
+    if logits.is_cuda and HAS_TRITON:
+        grad = _fused_kl_gather_backward_triton(logits, reference_logits, labels, lse, ref_lse, grad_logps, grad_kl)
+        return grad, None, None
+
+    ps = (logits.float() - lse.unsqueeze(-1)).exp()
+    ref_ps = (reference_logits.float() - ref_lse.unsqueeze(-1)).exp()
+
+    # d logps / dx = onehot - p, d kl / dx = p - p_ref
+    grad = (grad_kl - grad_logps).unsqueeze(-1) * ps - grad_kl.unsqueeze(-1) * ref_ps
+    grad.scatter_add_(1, labels.unsqueeze(-1), grad_logps.unsqueeze(-1))
+    return grad.to(logits.dtype), None, None
+
+
+fused_kl_gather.register_autograd(_backward, setup_context=_setup_context)
+
+
+def fused_tdpo_logps(
+    logits: torch.FloatTensor,
+    reference_logits: torch.FloatTensor,
+    labels: torch.LongTensor,
+):
+    """Fused counterpart of the vocab-sized part of tdpo_get_batch_logps.
+
+    Takes the unshifted logits/labels and runs fused_kl_gather over all batch_size * sequence_length rows, so the
+    logits are viewed as 2D without a copy; the last position of each sequence is masked out instead of sliced off.
+
+    Returns:
+        Per-sequence sums of the logps margin, kl divergence and policy logps, plus the number of unmasked tokens.
+    """
+    B, T, V = logits.shape
+    if (reference_logits.dtype == torch.float8_e4m3fn and reference_logits.is_cuda
+            and torch.cuda.get_device_capability(reference_logits.device) < (8, 9)):
+        # triton can only load fp8e4nv on sm_89+ (e.g. not on A100)
+        reference_logits = reference_logits.to(torch.bfloat16)
+    shifted_labels = F.pad(labels[:, 1:], (0, 1), value=-100)
+    loss_mask = (shifted_labels != -100)
+    # dummy token; we'll ignore the losses on these tokens later
+    shifted_labels = shifted_labels.masked_fill(~loss_mask, 0)
+
+    per_token_logps, per_reference_token_logps, per_position_kl, _, _ = fused_kl_gather(
+        logits.reshape(B * T, V),
+        reference_logits.reshape(B * T, V),
+        shifted_labels.reshape(-1),
+    )
+    per_token_logps = per_token_logps.view(B, T)
+    per_reference_token_logps = per_reference_token_logps.view(B, T)
+    per_position_kl = per_position_kl.view(B, T)
+
+    return ((per_token_logps - per_reference_token_logps) * loss_mask).sum(-1), \
+        (per_position_kl * loss_mask).sum(-1), \
+        (per_token_logps * loss_mask).sum(-1), \
+        loss_mask.sum(-1).float()
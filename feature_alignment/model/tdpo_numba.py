@@ -0,0 +1,91 @@
+import math
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+try:
+    from numba import njit, prange
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+
+
+if HAS_NUMBA:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _tdpo_rows(logits, reference_logits, labels, out_logps, out_reference_logps, out_kl):
+        """One pass over each row: online log-normalizers of both models and the running kl sum, then the labelled log-probs.
+
+        Rows are processed in parallel. The running maxima start at the first element rather than -inf, which keeps every
+        intermediate finite as fastmath requires.
+        """
+        N, V = logits.shape
+        for i in prange(N):
+            m = logits[i, 0]
+            d = 0.0
+            ref_m = reference_logits[i, 0]
+            ref_d = 0.0
+            # sum(exp(r - ref_m) * (r - x)), rescaled together with ref_d
+            ref_a = 0.0
+            for v in range(V):
+                x = logits[i, v]
+                r = reference_logits[i, v]
+                if x > m:
+                    d = d * math.exp(m - x) + 1.0
+                    m = x
+                else:
+                    d += math.exp(x - m)
+                if r > ref_m:
+                    scale = math.exp(ref_m - r)
+                    ref_d = ref_d * scale + 1.0
+                    ref_a = ref_a * scale + (r - x)
+                    ref_m = r
+                else:
+                    e = math.exp(r - ref_m)
+                    ref_d += e
+                    ref_a += e * (r - x)
+
+            lse = m + math.log(d)
+            ref_lse = ref_m + math.log(ref_d)
+            out_logps[i] = logits[i, labels[i]] - lse
+            out_reference_logps[i] = reference_logits[i, labels[i]] - ref_lse
+            out_kl[i] = ref_a / ref_d - ref_lse + lse
+
+
+def numba_tdpo_logps(
+    logits: torch.FloatTensor,
+    reference_logits: torch.FloatTensor,
+    labels: torch.LongTensor,
+):
+    """CPU counterpart of fused_tdpo_logps for evaluation; not differentiable.
+
+    Takes the unshifted logits/labels, runs _tdpo_rows over all batch_size * sequence_length rows and masks out the last
+    position of each sequence.
+
+    Returns:
+        Per-sequence sums of the logps margin, kl divergence and policy logps, plus the number of unmasked tokens.
+    """
+    B, T, V = logits.shape
+    shifted_labels = F.pad(labels[:, 1:], (0, 1), value=-100)
+    loss_mask = (shifted_labels != -100)
+    # dummy token; we'll ignore the losses on these tokens later
+    shifted_labels = shifted_labels.masked_fill(~loss_mask, 0)
+
+    per_token_logps = np.empty(B * T, dtype=np.float32)
+    per_reference_token_logps = np.empty(B * T, dtype=np.float32)
+    per_position_kl = np.empty(B * T, dtype=np.float32)
+    _tdpo_rows(
+        logits.detach().float().reshape(B * T, V).contiguous().numpy(),
+        reference_logits.detach().float().reshape(B * T, V).contiguous().numpy(),
+        shifted_labels.reshape(-1).contiguous().numpy(),
+        per_token_logps,
+        per_reference_token_logps,
+        per_position_kl,
+    )
+    per_token_logps = torch.from_numpy(per_token_logps).view(B, T)
+    per_reference_token_logps = torch.from_numpy(per_reference_token_logps).view(B, T)
+    per_position_kl = torch.from_numpy(per_position_kl).view(B, T)
+
+    return ((per_token_logps - per_reference_token_logps) * loss_mask).sum(-1), \
+        (per_position_kl * loss_mask).sum(-1), \
+        (per_token_logps * loss_mask).sum(-1), \
+        loss_mask.sum(-1).float()
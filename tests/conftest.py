@@ -0,0 +1,63 @@
+import torch
+
+DEVICES = ['cpu'] + (['cuda'] if torch.cuda.is_available() else [])
+
+
+def reference_token_terms(logits, reference_logits, labels):
+    """The original tdpo_get_batch_logps formulation, per position and in float32.
+
+    Returns the label log-probs under the policy and the reference, and kl(reference || policy), each shaped like labels.
+    """
+    vocab_logps = logits.float().log_softmax(-1)
+    reference_vocab_ps = reference_logits.float().softmax(-1)
+    reference_vocab_logps = reference_vocab_ps.log()
+
+    kl = (reference_vocab_ps * (reference_vocab_logps - vocab_logps)).sum(-1)
+    logps = vocab_logps.gather(-1, labels.unsqueeze(-1)).squeeze(-1)
+    ref_logps = reference_vocab_logps.gather(-1, labels.unsqueeze(-1)).squeeze(-1)
+    return logps, ref_logps, kl
+
+
+def reference_masked_sums(logits, reference_logits, labels, loss_mask):
+    """Per-sequence sums of the logps margin, kl and policy logps, plus the token count, on already shifted inputs."""
+    logps, ref_logps, kl = reference_token_terms(logits, reference_logits, labels)
+    loss_mask = loss_mask.float()
+    return ((logps - ref_logps) * loss_mask).sum(-1), \
+        (kl * loss_mask).sum(-1), \
+        (logps * loss_mask).sum(-1), \
+        loss_mask.sum(-1)
+
+
+def reference_batch_logps(logits, reference_logits, labels):
+    """The original tdpo_get_batch_logps (summed, unshifted inputs with -100 labels)."""
+    labels = labels[:, 1:].clone()
+    loss_mask = (labels != -100)
+    labels[~loss_mask] = 0
+    return reference_masked_sums(logits[:, :-1], reference_logits[:, :-1], labels, loss_mask)[:3]
+
+
+def make_logits(*shape, device='cpu', noise=0.1, seed=0):
+    """Random policy logits, reference logits within `noise` of them, and labels in [0, vocab_size).
+
+    The logits have shape `shape` and the labels shape[:-1].
+    """
+    generator = torch.Generator().manual_seed(seed)
+    logits = 3 * torch.randn(*shape, generator=generator)
+    reference_logits = logits + noise * torch.randn(*shape, generator=generator)
+    labels = torch.randint(0, shape[-1], shape[:-1], generator=generator)
+    return logits.to(device), reference_logits.to(device), labels.to(device)
+
+
+def reference_tdpo_loss(chosen_logps_margin, rejected_logps_margin, chosen_position_kl, rejected_position_kl, beta, alpha=None):
+    """The original TDPO1Model.loss, or TDPO2Model.loss when alpha is given."""
+    chosen_values = chosen_logps_margin + chosen_position_kl
+    rejected_values = rejected_logps_margin + rejected_position_kl
+
+    chosen_rejected_logps_margin = chosen_logps_margin - rejected_logps_margin
+    if alpha is None:
+        logits = chosen_rejected_logps_margin - (rejected_position_kl - chosen_position_kl)
+    else:
+        logits = chosen_rejected_logps_margin - alpha * (rejected_position_kl - chosen_position_kl.detach())
+    losses = -torch.nn.functional.logsigmoid(beta * logits)
+
+    return losses, beta * chosen_values.detach(), beta * rejected_values.detach()
@@ -0,0 +1,61 @@
+import pytest
+import torch
+from omegaconf import OmegaConf
+
+from feature_alignment.model.tdpo import TDPO2Model, _tdpo_core_impl, _tdpo_loss_impl
+from conftest import DEVICES, make_logits, reference_masked_sums, reference_tdpo_loss
+
+
+@pytest.mark.parametrize('device', DEVICES)
+def test_core_matches_baseline_under_bf16_autocast(device):
+    # policy close to the reference, so the per-token kl is small (~1e-3) next to a log-normalizer of ~10
+    B, T, V = 4, 16, 32000
+    logits, reference_logits, labels = make_logits(B, T, V, device=device, noise=0.05)
+    loss_mask = torch.rand(B, T, generator=torch.Generator().manual_seed(1)).to(device) > 0.2
+
+    reference_logits = reference_logits.to(torch.bfloat16)
+
+    expected = reference_masked_sums(logits, reference_logits, labels, loss_mask)
+    with torch.autocast(device_type=device, dtype=torch.bfloat16):
+        actual = _tdpo_core_impl(logits, reference_logits, labels, loss_mask)
+
+    for value, expected_value in zip(actual[:3], expected[:3]):
+        torch.testing.assert_close(value, expected_value, rtol=1e-3, atol=1e-4)
+    torch.testing.assert_close(actual[3], expected[3])
+
+
+def make_loss_inputs(B=64):
+    # spread wide enough that beta * logits reaches both tails of the sigmoid
+    generator = torch.Generator().manual_seed(0)
+    logps_margins = 20 * torch.randn(2, B, generator=generator)
+    position_kls = 5 * torch.rand(2, B, generator=generator)
+    return logps_margins[0], logps_margins[1], position_kls[0], position_kls[1]
+
+
+@pytest.mark.parametrize('alpha', [None, 0.5])
+def test_loss_matches_original(alpha):
+    inputs = make_loss_inputs()
+    # TDPO-1 is alpha = 1; TDPO-2 detaches chosen_position_kl, which does not change the values
+    actual = _tdpo_loss_impl(*inputs, beta=0.1, alpha=1.0 if alpha is None else alpha)
+    expected = reference_tdpo_loss(*inputs, beta=0.1, alpha=alpha)
+
+    for value, expected_value in zip(actual, expected):
+        torch.testing.assert_close(value, expected_value)
+
+
+def test_tdpo2_loss_gradients():
+    config = OmegaConf.create({'trainer': {'precision': '32-true'}, 'loss': {'beta': 0.1, 'alpha': 0.5}})
+    tdpo2 = TDPO2Model(config)
+
+    inputs = [value.clone().requires_grad_() for value in make_loss_inputs()]
+    losses, _, _ = tdpo2.loss(*inputs)
+    grads = torch.autograd.grad(losses.sum(), inputs, allow_unused=True)
+
+    expected_inputs = [value.detach().requires_grad_() for value in inputs]
+    expected_losses, _, _ = reference_tdpo_loss(*expected_inputs, beta=0.1, alpha=0.5)
+    expected_grads = torch.autograd.grad(expected_losses.sum(), expected_inputs, allow_unused=True)
+
+    # chosen_position_kl only enters the TDPO-2 loss detached
+    assert grads[2] is None or torch.count_nonzero(grads[2]) == 0
+    for grad, expected_grad in zip(grads[:2] + grads[3:], expected_grads[:2] + expected_grads[3:]):
+        torch.testing.assert_close(grad, expected_grad)
@@ -0,0 +1,74 @@
+import copy
+
+import pytest
+import torch
+from omegaconf import OmegaConf
+from transformers import Gemma2Config, Gemma2ForCausalLM, LlamaConfig, LlamaForCausalLM
+
+from feature_alignment.model.tdpo import TDPO1Model
+
+V = 101
+SMALL = dict(vocab_size=V, hidden_size=32, intermediate_size=64, num_hidden_layers=2, num_attention_heads=4, num_key_value_heads=2)
+
+
+def llama():
+    return LlamaForCausalLM(LlamaConfig(**SMALL))
+
+
+def gemma2():
+    # soft-capped well inside the logit range, so the tanh actually matters
+    return Gemma2ForCausalLM(Gemma2Config(**SMALL, head_dim=8, final_logit_softcapping=0.5, attn_implementation='eager'))
+
+
+def make_tdpo(policy):
+    config = OmegaConf.create({
+        'mode': 'train',
+        'trainer': {'precision': '32-true'},
+        'loss': {'beta': 0.1, 'alpha': 0.5, 'logits_chunk_size': None},
+    })
+    tdpo = TDPO1Model(config)
+    tdpo.policy = policy
+    tdpo.reference_model = copy.deepcopy(policy)
+    with torch.no_grad():
+        for param in tdpo.reference_model.parameters():
+            param.add_(0.01 * torch.randn_like(param))
+            param.requires_grad = False
+    return tdpo
+
+
+def make_batch(B=4, T=13):
+    generator = torch.Generator().manual_seed(0)
+    input_ids = torch.randint(0, V, (B, T), generator=generator)
+    attention_mask = torch.ones(B, T, dtype=torch.long)
+    attention_mask[1, -4:] = 0
+    attention_mask[3, -2:] = 0
+    labels = input_ids.masked_fill(attention_mask == 0, -100)
+    labels[:, :3] = -100
+    return {
+        'concatenated_combined_input_ids': input_ids,
+        'concatenated_combined_attention_mask': attention_mask,
+        'concatenated_labels': labels,
+    }
+
+
+@pytest.mark.parametrize('make_policy', [llama, gemma2])
+def test_chunked_forward_matches_full_forward(make_policy):
+    torch.manual_seed(0)
+    tdpo = make_tdpo(make_policy())
+    batch = make_batch()
+    params = [param for param in tdpo.policy.parameters() if param.requires_grad]
+    weights = torch.randn(3, batch['concatenated_labels'].shape[0])
+
+    def outputs_and_grads(forward):
+        outputs = forward(tdpo.policy, batch)
+        loss = sum((weight * output).sum() for weight, output in zip(weights, outputs))
+        return outputs, torch.autograd.grad(loss, params)
+
+    expected, expected_grads = outputs_and_grads(tdpo.full_forward)
+    # 5 does not divide the sequence length, so the last chunk is a partial one
+    actual, actual_grads = outputs_and_grads(lambda model, batch: tdpo.chunked_forward(model, batch, chunk_size=5))
+
+    for value, expected_value in zip(actual, expected):
+        torch.testing.assert_close(value, expected_value, rtol=1e-4, atol=1e-5)
+    for grad, expected_grad in zip(actual_grads, expected_grads):
+        torch.testing.assert_close(grad, expected_grad, rtol=1e-4, atol=1e-5)
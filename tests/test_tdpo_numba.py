@@ -0,0 +1,38 @@
+import pytest
+import torch
+
+from feature_alignment.model.tdpo import tdpo_get_batch_logps
+from feature_alignment.model.tdpo_numba import HAS_NUMBA, numba_tdpo_logps
+from conftest import make_logits, reference_batch_logps
+
+pytestmark = pytest.mark.skipif(not HAS_NUMBA, reason='numba is not installed')
+
+
+def make_inputs(B=3, T=9, V=5003):
+    logits, reference_logits, labels = make_logits(B, T, V)
+    # left-padded prompt and right padding, as in the concatenated batch
+    labels[:, :3] = -100
+    labels[0, -2:] = -100
+    return logits, reference_logits, labels
+
+
+def test_numba_matches_reference():
+    logits, reference_logits, labels = make_inputs()
+
+    logps_margin, position_kl, logps, mask_sum = numba_tdpo_logps(logits, reference_logits, labels)
+    expected = reference_batch_logps(logits, reference_logits, labels)
+
+    # fastmath reassociates the sums, so allow a little more than float32 round-off
+    for value, expected_value in zip((logps_margin, position_kl, logps), expected):
+        torch.testing.assert_close(value, expected_value, rtol=1e-4, atol=1e-4)
+    torch.testing.assert_close(mask_sum, (labels[:, 1:] != -100).sum(-1).float())
+
+
+def test_numba_flag_matches_torch_path():
+    logits, reference_logits, labels = make_inputs()
+
+    for average_log_prob in (False, True):
+        actual = tdpo_get_batch_logps(logits, reference_logits, labels, average_log_prob=average_log_prob, numba=True)
+        expected = tdpo_get_batch_logps(logits, reference_logits, labels, average_log_prob=average_log_prob)
+        for value, expected_value in zip(actual, expected):
+            torch.testing.assert_close(value, expected_value, rtol=1e-4, atol=1e-4)